@@ -1,20 +1,30 @@
 import asyncio
+import csv
+import io
 import logging
 import os
-from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
+from datetime import date, datetime
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Callable, Awaitable, AsyncIterator
 
 import google.generativeai as genai
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
 from aiogram.enums import ChatAction, ParseMode
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+from aiogram.filters.callback_data import CallbackData
 from aiogram.filters.command import Command
 from aiogram.filters.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, TelegramObject
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from dotenv import load_dotenv
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, select, func, and_
+from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, Index, select, update, func, and_, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import ProgrammingError
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
@@ -26,17 +36,33 @@ load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 DATABASE_URL = os.getenv('DATABASE_URL')
+REDIS_URL = os.getenv('REDIS_URL')
+DEV = os.getenv('DEV', '').strip().lower() in ('1', 'true', 'yes', 'on')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # public base URL; polling is used when unset
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')  # required in webhook mode; Telegram echoes it in every request
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', '8080'))
 MAX_DAILY_CONSULTATIONS = 10
 CONSULTATION_TIMEOUT = 300  # 5 minutes in seconds
+SCHEMA_VERSION = 2  # bump when models or indexes change so init_db runs create_all again
+CONVERSATION_HISTORY_LIMIT = 3  # QA pairs kept in FSM state and sent back as context
+STREAM_EDIT_CHARS = 200  # new characters required before a streamed answer is edited again
+STREAM_EDIT_INTERVAL = 1.0  # minimum seconds between streamed edits, to stay under Telegram's flood limit
+TELEGRAM_MESSAGE_LIMIT = 4096  # maximum characters in one Telegram message
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
+logging.getLogger('sqlalchemy.engine').setLevel(logging.WARNING)
 
 # Database initialization
 Base = declarative_base()
-engine = create_async_engine(DATABASE_URL, echo=True)
+engine = create_async_engine(DATABASE_URL, echo=False, pool_size=20, max_overflow=30, pool_pre_ping=True,
+                             pool_recycle=1800)
 async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+# Timestamps are filled in by Postgres, in UTC like the rest of the stored datetimes
+UTC_NOW = func.timezone('utc', func.now())
 
 
 # Database models
@@ -49,8 +75,8 @@ class User(Base):
     username = Column(String)
     phone_number = Column(String)
     language_code = Column(String)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    last_active = Column(DateTime)
+    created_at = Column(DateTime, server_default=UTC_NOW)
+    last_active = Column(DateTime, server_default=UTC_NOW)
     consultation_count = Column(Integer, default=0)
     daily_consultation_count = Column(Integer, default=0)
     last_consultation_date = Column(DateTime)
@@ -61,30 +87,58 @@ class User(Base):
 
 class Consultation(Base):
     __tablename__ = 'consultations'
+    __table_args__ = (Index('ix_cons_user_created', 'user_id', 'created_at'),
+                      Index('ix_cons_user_feedback', 'user_id', 'feedback_score'))
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, nullable=False)
     category = Column(String)
     content = Column(String, nullable=False)
     response = Column(String)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, server_default=UTC_NOW)
     resolved_at = Column(DateTime)
     is_resolved = Column(Boolean, default=False)
     feedback_score = Column(Integer)
     feedback_text = Column(String)
 
 
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+    version = Column(Integer, primary_key=True, autoincrement=False)
+
+
+# Callback data for the consultation rating buttons
+class RateCallback(CallbackData, prefix='rate'):
+    consultation_id: int
+    score: int
+
+
 # States for conversation management
 class ConsultationStates(StatesGroup):
     category_selection = State()
     conversation = State()
 
 
-# Initialize bot with FSM storage
-storage = MemoryStorage()
+# Initialize bot with FSM storage (Redis keeps state shared across workers and restarts)
+if REDIS_URL:
+    # Imported here because RedisStorage needs the optional redis package
+    from aiogram.fsm.storage.redis import RedisStorage
+    storage = RedisStorage.from_url(REDIS_URL)
+else:
+    storage = MemoryStorage()
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher(storage=storage)
 
 
+# AI prompt constants
+CATEGORY_PROMPTS = {
+    'general': "Foydalanuvchining umumiy tibbiy holati haqidagi savoliga malakali shifokor sifatida javob bering: ",
+    'medicine': "Dori-darmonlar haqida malakali shifokor sifatida ma'lumot bering, ularning maqsadi, yon ta'siri va dozasi haqida ma'lumot bering, ammo o'z-o'zini davolashni tavsiya etmang: ",
+    'hospitals': "Kasalxonalar va tibbiy muassasalar haqida malakali shifokor sifatida ma'lumot bering, ularning ixtisosligi, manzili va aloqa ma'lumotlarini taqdim eting: ",
+    'specialists': "Tibbiyot mutaxassislari haqida malakali shifokor sifatida ma'lumot bering, ularning ixtisosligi, tajribasi va aloqa ma'lumotlarini taqdim eting: "}
+DISCLAIMER = ("\n\n⚠️ Eslatma: Ushbu ma'lumot faqat umumiy maslahat uchun. "
+              "Aniq tashxis va davolanish uchun shifokorga murojaat qiling.")
+
+
 # AI response generator
 class AIResponseGenerator:
     def __init__(self):
@@ -95,81 +149,138 @@ class AIResponseGenerator:
                         "va davolanish uchun ularni haqiqiy tibbiyot mutaxassislariga murojaat qilishga undab turing. "
                         "Doim professional va g'amxo'rlik ohangida javob bering. Oldingi suhbat tarixini inobatga olgan "
                         "holda javoblarni shakllantiring. O'zbek tilida javob bering.")
+        self._prefix_by_category = {category: f"{self.context}\n{text}\n" for category, text in CATEGORY_PROMPTS.items()}
+        self._default_prefix = f"{self.context}\n\n"
 
-    async def generate_response(self, category: str, context: str) -> str:
+    async def stream_response(self, category: str, context: str) -> AsyncIterator[str]:
+        # Yields the answer accumulated so far; the last value is the complete answer with the disclaimer
         try:
-            category_prompts = {
-                'general': "Foydalanuvchining umumiy tibbiy holati haqidagi savoliga malakali shifokor sifatida javob bering: ",
-                'medicine': "Dori-darmonlar haqida malakali shifokor sifatida ma'lumot bering, ularning maqsadi, yon ta'siri va dozasi haqida ma'lumot bering, ammo o'z-o'zini davolashni tavsiya etmang: ",
-                'hospitals': "Kasalxonalar va tibbiy muassasalar haqida malakali shifokor sifatida ma'lumot bering, ularning ixtisosligi, manzili va aloqa ma'lumotlarini taqdim eting: ",
-                'specialists': "Tibbiyot mutaxassislari haqida malakali shifokor sifatida ma'lumot bering, ularning ixtisosligi, tajribasi va aloqa ma'lumotlarini taqdim eting: "}
-
-            prompt = f"{self.context}\n{category_prompts.get(category, '')}\n{context}"
-            response = await asyncio.to_thread(lambda: self.model.generate_content(prompt).text)
-            disclaimer = ("\n\n⚠️ Eslatma: Ushbu ma'lumot faqat umumiy maslahat uchun. "
-                          "Aniq tashxis va davolanish uchun shifokorga murojaat qiling.")
-            return f"{response}{disclaimer}"
+            prompt = self._prefix_by_category.get(category, self._default_prefix) + context
+            response = ""
+            async for chunk in await self.model.generate_content_async(prompt, stream=True):
+                response += chunk.text
+                yield response
+            yield f"{response}{DISCLAIMER}"
         except Exception as e:
             logger.error(f"AI response generation error: {e}")
-            return "Kechirasiz, texnik nosozlik yuz berdi. Iltimos, keyinroq urinib ko'ring."
+            yield "Kechirasiz, texnik nosozlik yuz berdi. Iltimos, keyinroq urinib ko'ring."
+
 
+# Created on first use so importing the module does not configure Gemini or need GEMINI_API_KEY
+@lru_cache(maxsize=1)
+def get_ai() -> AIResponseGenerator:
+    return AIResponseGenerator()
 
-ai_generator = AIResponseGenerator()
+
+@asynccontextmanager
+async def session_scope(session: Optional[AsyncSession] = None) -> AsyncIterator[AsyncSession]:
+    # Reuse the per-update session when one is given, otherwise open a short-lived one
+    if session is not None:
+        yield session
+    else:
+        async with async_session() as new_session:
+            yield new_session
 
 
 # Database manager
 class DatabaseManager:
     @staticmethod
     async def init_db():
+        # Schema creation is skipped once the current version is recorded; DEV always re-runs it
+        if not DEV and await DatabaseManager.is_schema_current():
+            return
         async with engine.begin() as conn:
             await conn.run_sync(Base.metadata.create_all)
+            # create_all only builds indexes together with new tables, so add them to existing ones too
+            for index in Consultation.__table__.indexes:
+                await conn.run_sync(index.create, checkfirst=True)
+            # Likewise, server-side defaults have to be attached to columns of existing tables
+            for table in Base.metadata.sorted_tables:
+                for column in table.columns:
+                    if column.server_default is not None:
+                        default = column.server_default.arg.compile(dialect=conn.dialect,
+                                                                    compile_kwargs={'literal_binds': True})
+                        await conn.execute(text(f"ALTER TABLE {table.name} ALTER COLUMN {column.name} "
+                                                f"SET DEFAULT {default}"))
+            await conn.execute(insert(SchemaVersion).values(version=SCHEMA_VERSION).on_conflict_do_nothing())
 
     @staticmethod
-    async def get_user(user_id: int) -> Optional[User]:
-        async with async_session() as session:
+    async def is_schema_current() -> bool:
+        try:
+            async with engine.connect() as conn:
+                result = await conn.execute(select(SchemaVersion.version).where(
+                    SchemaVersion.version == SCHEMA_VERSION))
+                return result.scalar() is not None
+        except ProgrammingError:
+            # schema_version table does not exist yet
+            return False
+
+    @staticmethod
+    async def warm_up_pool():
+        # Open pool_size connections up front so the first requests do not pay for the handshakes
+        # This is only an optimization, so failures are logged and never abort startup
+        connections = [engine.connect() for _ in range(engine.pool.size())]
+        results = await asyncio.gather(*(conn.start() for conn in connections), return_exceptions=True)
+        await asyncio.gather(*(conn.close() for conn, result in zip(connections, results)
+                               if not isinstance(result, BaseException)), return_exceptions=True)
+        failures = [result for result in results if isinstance(result, BaseException)]
+        if failures:
+            logger.warning(f"Connection pool warm-up opened {len(connections) - len(failures)} of "
+                           f"{len(connections)} connections: {failures[0]}")
+
+    @staticmethod
+    async def get_user(user_id: int, session: Optional[AsyncSession] = None) -> Optional[User]:
+        async with session_scope(session) as session:
             result = await session.execute(select(User).where(User.user_id == user_id))
             return result.scalar_one_or_none()
 
     @staticmethod
-    async def add_or_update_user(user: types.User) -> User:
-        async with async_session() as session:
-            db_user = await DatabaseManager.get_user(user.id)
-            if db_user is None:
-                db_user = User(user_id=user.id, first_name=user.first_name, last_name=user.last_name,
-                               username=user.username, language_code=user.language_code, created_at=datetime.utcnow(),
-                               last_active=datetime.utcnow())
-                session.add(db_user)
-            else:
-                db_user.last_active = datetime.utcnow()
-                db_user.first_name = user.first_name
-                db_user.last_name = user.last_name
-                db_user.username = user.username
+    async def get_daily_count(user_id: int, session: Optional[AsyncSession] = None) -> Optional[int]:
+        # None means the user is not registered yet
+        async with session_scope(session) as session:
+            result = await session.execute(select(User.daily_consultation_count).where(User.user_id == user_id))
+            return result.scalar_one_or_none()
 
-            await session.commit()
-            return db_user
+    @staticmethod
+    async def get_user_summary(user_id: int, session: Optional[AsyncSession] = None) -> Optional[Any]:
+        async with session_scope(session) as session:
+            query = (select(User.first_name, User.created_at, User.consultation_count, User.daily_consultation_count,
+                            User.feedback_score).where(User.user_id == user_id))
+            result = await session.execute(query)
+            return result.one_or_none()
 
     @staticmethod
-    async def update_consultation_count(user_id: int):
-        async with async_session() as session:
-            user = await DatabaseManager.get_user(user_id)
-            if user:
-                user.consultation_count += 1
-                user.daily_consultation_count += 1
-                user.last_consultation_date = datetime.utcnow()
-                await session.commit()
+    async def add_or_update_user(user: types.User, session: Optional[AsyncSession] = None) -> User:
+        async with session_scope(session) as session:
+            query = (insert(User).values(user_id=user.id, first_name=user.first_name, last_name=user.last_name,
+                                         username=user.username, language_code=user.language_code)
+                     .on_conflict_do_update(index_elements=[User.user_id],
+                                            set_={'first_name': user.first_name, 'last_name': user.last_name,
+                                                  'username': user.username, 'last_active': UTC_NOW})
+                     .returning(User))
+            result = await session.execute(query)
+            db_user = result.scalar_one()
+            await session.commit()
+            return db_user
 
     @staticmethod
-    async def save_consultation(user_id: int, category: str, question: str, response: str) -> Consultation:
-        async with async_session() as session:
-            consultation = Consultation(user_id=user_id, category=category, content=question, response=response,
-                                        created_at=datetime.utcnow())
+    async def save_consultation(user_id: int, category: str, question: str, response: str,
+                                session: Optional[AsyncSession] = None) -> Consultation:
+        # Store the consultation and bump the user's counters in a single transaction
+        async with session_scope(session) as session:
+            consultation = Consultation(user_id=user_id, category=category, content=question, response=response)
             session.add(consultation)
+            await session.execute(update(User).where(User.user_id == user_id).values(
+                consultation_count=User.consultation_count + 1,
+                daily_consultation_count=User.daily_consultation_count + 1,
+                last_consultation_date=UTC_NOW))
             await session.commit()
             return consultation
 
     @staticmethod
-    async def update_feedback(consultation_id: int, score: int, feedback_text: Optional[str] = None):
-        async with async_session() as session:
+    async def update_feedback(consultation_id: int, score: int, feedback_text: Optional[str] = None,
+                              session: Optional[AsyncSession] = None):
+        async with session_scope(session) as session:
             consultation = await session.get(Consultation, consultation_id)
             if consultation:
                 consultation.feedback_score = score
@@ -182,8 +293,8 @@ class DatabaseManager:
 # Statistics manager
 class StatisticsManager:
     @staticmethod
-    async def get_category_stats(user_id: int) -> List[Any]:
-        async with async_session() as session:
+    async def get_category_stats(user_id: int, session: Optional[AsyncSession] = None) -> List[Any]:
+        async with session_scope(session) as session:
             query = (
             select(Consultation.category, func.count(Consultation.id)).where(Consultation.user_id == user_id).group_by(
                 Consultation.category).order_by(func.count(Consultation.id).desc()))
@@ -191,24 +302,23 @@ class StatisticsManager:
             return result.all()
 
     @staticmethod
-    async def get_weekly_activity(user_id: int) -> Dict[str, int]:
-        async with async_session() as session:
-            today = datetime.now()
-            week_ago = today - timedelta(days=7)
-            query = (select(func.date(Consultation.created_at), func.count(Consultation.id)).where(
-                and_(Consultation.user_id == user_id, Consultation.created_at >= week_ago)).group_by(
-                func.date(Consultation.created_at)).order_by(func.date(Consultation.created_at)))
-            result = await session.execute(query)
-            daily_counts = {str(date): count for date, count in result}
-            week_days = {}
-            for i in range(7):
-                date = (today - timedelta(days=i)).strftime('%Y-%m-%d')
-                week_days[date] = daily_counts.get(date, 0)
-            return week_days
+    async def get_weekly_activity(user_id: int, session: Optional[AsyncSession] = None) -> Dict[date, int]:
+        async with session_scope(session) as session:
+            # Postgres builds the zero-filled 7-day calendar, oldest day first. Days come from the UTC clock
+            # because created_at is stored as UTC, whatever the server's TimeZone setting is.
+            query = text("SELECT d::date, COALESCE(c.cnt, 0) "
+                         "FROM generate_series(timezone('utc', now())::date - 6, timezone('utc', now())::date, "
+                         "interval '1 day') AS d "
+                         "LEFT JOIN (SELECT date(created_at) AS dt, count(*) AS cnt FROM consultations "
+                         "WHERE user_id = :user_id AND created_at >= timezone('utc', now())::date - 6 "
+                         "GROUP BY 1) AS c "
+                         "ON c.dt = d::date ORDER BY d")
+            result = await session.execute(query, {'user_id': user_id})
+            return {day: count for day, count in result}
 
     @staticmethod
-    async def get_feedback_distribution(user_id: int) -> Dict[int, int]:
-        async with async_session() as session:
+    async def get_feedback_distribution(user_id: int, session: Optional[AsyncSession] = None) -> Dict[int, int]:
+        async with session_scope(session) as session:
             query = (select(Consultation.feedback_score, func.count(Consultation.id)).where(
                 and_(Consultation.user_id == user_id, Consultation.feedback_score.isnot(None))).group_by(
                 Consultation.feedback_score).order_by(Consultation.feedback_score))
@@ -216,16 +326,17 @@ class StatisticsManager:
             return {score: count for score, count in result}
 
     @staticmethod
-    async def get_recent_consultations(user_id: int, limit: int = 5) -> List[Consultation]:
-        async with async_session() as session:
+    async def get_recent_consultations(user_id: int, limit: int = 5,
+                                       session: Optional[AsyncSession] = None) -> List[Consultation]:
+        async with session_scope(session) as session:
             query = (select(Consultation).where(Consultation.user_id == user_id).order_by(
                 Consultation.created_at.desc()).limit(limit))
             result = await session.execute(query)
             return result.scalars().all()
 
 
-# Keyboard functions
-def get_main_keyboard() -> ReplyKeyboardMarkup:
+# Keyboards are static, so they are built once at import time and reused
+def _build_main_keyboard() -> ReplyKeyboardMarkup:
     keyboard = ReplyKeyboardBuilder()
     keyboard.add(KeyboardButton(text="🩺 Savol berish"))
     keyboard.add(KeyboardButton(text="📊 Statistika"))
@@ -234,13 +345,13 @@ def get_main_keyboard() -> ReplyKeyboardMarkup:
     return keyboard.as_markup(resize_keyboard=True)
 
 
-def get_contact_keyboard() -> ReplyKeyboardMarkup:
+def _build_contact_keyboard() -> ReplyKeyboardMarkup:
     keyboard = ReplyKeyboardBuilder()
     keyboard.add(KeyboardButton(text="📱 Telefon raqamni yuborish", request_contact=True))
     return keyboard.as_markup(resize_keyboard=True)
 
 
-def get_categories_keyboard() -> ReplyKeyboardMarkup:
+def _build_categories_keyboard() -> ReplyKeyboardMarkup:
     keyboard = ReplyKeyboardBuilder()
     keyboard.add(KeyboardButton(text="👨‍⚕️ Umumiy maslahat"))
     keyboard.add(KeyboardButton(text="💊 Dori-darmonlar"))
@@ -251,12 +362,55 @@ def get_categories_keyboard() -> ReplyKeyboardMarkup:
     return keyboard.as_markup(resize_keyboard=True)
 
 
+def _build_conversation_keyboard() -> ReplyKeyboardMarkup:
+    keyboard = ReplyKeyboardBuilder()
+    keyboard.add(KeyboardButton(text="🔙 Asosiy menyu"))
+    keyboard.add(KeyboardButton(text="🔄 Kategoriyani o'zgartirish"))
+    keyboard.adjust(1)
+    return keyboard.as_markup(resize_keyboard=True)
+
+
+_MAIN_KEYBOARD = _build_main_keyboard()
+_CONTACT_KEYBOARD = _build_contact_keyboard()
+_CATEGORIES_KEYBOARD = _build_categories_keyboard()
+_CONVERSATION_KEYBOARD = _build_conversation_keyboard()
+
+
+# Keyboard functions
+def get_main_keyboard() -> ReplyKeyboardMarkup:
+    return _MAIN_KEYBOARD
+
+
+def get_contact_keyboard() -> ReplyKeyboardMarkup:
+    return _CONTACT_KEYBOARD
+
+
+def get_categories_keyboard() -> ReplyKeyboardMarkup:
+    return _CATEGORIES_KEYBOARD
+
+
+def get_conversation_keyboard() -> ReplyKeyboardMarkup:
+    return _CONVERSATION_KEYBOARD
+
+
+# Middlewares
+class DbSessionMiddleware(BaseMiddleware):
+    # Opens one database session per update and passes it to handlers as `session`
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        async with async_session() as session:
+            data['session'] = session
+            return await handler(event, data)
+
+
+dp.update.outer_middleware(DbSessionMiddleware())
+
+
 # Message handlers
 @dp.message(Command("start"))
-async def start_command(message: types.Message, state: FSMContext):
+async def start_command(message: types.Message, state: FSMContext, session: AsyncSession):
     try:
-        user_id = message.from_user.id
-        await DatabaseManager.add_or_update_user(message.from_user)
+        user = await DatabaseManager.add_or_update_user(message.from_user, session=session)
         welcome_text = (f"👋 Assalomu alaykum, {message.from_user.first_name}!\n\n"
                         "🏥 Doctor AI - sizning shaxsiy tibbiy maslahatchi botingizga "
                         "xush kelibsiz.\n\n"
@@ -266,8 +420,7 @@ async def start_command(message: types.Message, state: FSMContext):
                         "• Kasalxonalar va shifokorlar haqida ma'lumot\n\n"
                         "⚠️ Eslatma: Bot bergan maslahatlar faqat umumiy xarakterga ega.")
         await state.clear()
-        user = await DatabaseManager.get_user(user_id)
-        if user and user.phone_number:
+        if user.phone_number:
             await message.answer(welcome_text, reply_markup=get_main_keyboard())
         else:
             await message.answer(f"{welcome_text}\n\n📱 Botdan foydalanish uchun telefon raqamingizni yuboring.",
@@ -278,14 +431,12 @@ async def start_command(message: types.Message, state: FSMContext):
 
 
 @dp.message(F.contact)
-async def handle_contact(message: types.Message):
+async def handle_contact(message: types.Message, session: AsyncSession):
     try:
-        user_id = message.from_user.id
-        async with async_session() as session:
-            user = await DatabaseManager.get_user(user_id)
-            if user:
-                user.phone_number = message.contact.phone_number
-                await session.commit()
+        user = await DatabaseManager.get_user(message.from_user.id, session=session)
+        if user:
+            user.phone_number = message.contact.phone_number
+            await session.commit()
         await message.answer("✅ Raqamingiz muvaffaqiyatli saqlandi!\n"
                              "Endi botdan to'liq foydalanishingiz mumkin.", reply_markup=get_main_keyboard())
     except Exception as e:
@@ -293,12 +444,18 @@ async def handle_contact(message: types.Message):
         await message.answer("Xatolik yuz berdi. Iltimos, qaytadan urinib ko'ring.")
 
 
-@dp.message(F.text == "🩺 Savol berish")
-async def ask_question(message: types.Message, state: FSMContext):
+# Main menu actions share one signature so handle_main_menu can dispatch them through a table
+MenuAction = Callable[[types.Message, FSMContext, AsyncSession], Awaitable[None]]
+
+
+async def ask_question(message: types.Message, state: FSMContext, session: AsyncSession):
     try:
         user_id = message.from_user.id
-        user = await DatabaseManager.get_user(user_id)
-        if user.daily_consultation_count >= MAX_DAILY_CONSULTATIONS:
+        daily_count = await DatabaseManager.get_daily_count(user_id, session=session)
+        if daily_count is None:
+            await message.answer("Botdan foydalanish uchun avval /start buyrug'ini yuboring.")
+            return
+        if daily_count >= MAX_DAILY_CONSULTATIONS:
             await message.answer("⚠️ Siz bugun ko'p savol berdingiz. Iltimos, ertaga qayta urinib ko'ring.")
             return
 
@@ -309,6 +466,85 @@ async def ask_question(message: types.Message, state: FSMContext):
         await message.answer("Xatolik yuz berdi. Iltimos, qaytadan urinib ko'ring.")
 
 
+async def show_statistics(message: types.Message, state: FSMContext, session: AsyncSession):
+    try:
+        user_id = message.from_user.id
+        # AsyncSession is not safe for concurrent use, so only one gathered query uses the update's session
+        # and the others open their own pooled sessions
+        user, category_stats, weekly_activity, feedback_dist, recent_consultations = await asyncio.gather(
+            DatabaseManager.get_user_summary(user_id, session=session), StatisticsManager.get_category_stats(user_id),
+            StatisticsManager.get_weekly_activity(user_id), StatisticsManager.get_feedback_distribution(user_id),
+            StatisticsManager.get_recent_consultations(user_id))
+        if not user:
+            await message.answer("Foydalanuvchi ma'lumotlari topilmadi.")
+            return
+
+        stats_message = ["📊 <b>Statistika</b>\n", f"👤 Foydalanuvchi: {user.first_name}",
+                         f"📅 Ro'yxatdan o'tgan sana: {user.created_at.strftime('%Y-%m-%d')}",
+                         f"💬 Jami maslahatlar: {user.consultation_count}",
+                         f"📈 Bugungi maslahatlar: {user.daily_consultation_count}",
+                         f"⭐ O'rtacha baho: {user.feedback_score:.1f}/5.0\n"]
+
+        if category_stats:
+            stats_message.append("📊 <b>Kategoriyalar bo'yicha statistika:</b>")
+            for category, count in category_stats:
+                stats_message.append(f"- {category}: {count} ta")
+            stats_message.append("")
+
+        stats_message.append("📅 <b>Haftalik faollik:</b>")
+        for day, count in weekly_activity.items():
+            stats_message.append(f"- {day.strftime('%A')}: {count} ta maslahat")
+        stats_message.append("")
+
+        if feedback_dist:
+            stats_message.append("⭐ <b>Baholar taqsimoti:</b>")
+            total_feedback = sum(feedback_dist.values())
+            for score, count in feedback_dist.items():
+                percentage = (count / total_feedback) * 100
+                stars = "⭐" * score
+                stats_message.append(f"{stars}: {count} ta ({percentage:.1f}%)")
+            stats_message.append("")
+
+        if recent_consultations:
+            stats_message.append("🕐 <b>Oxirgi maslahatlar:</b>")
+            for cons in recent_consultations:
+                created = cons.created_at.strftime("%Y-%m-%d %H:%M")
+                stats_message.append(f"- {created}: {cons.category}")
+
+        keyboard = InlineKeyboardBuilder()
+        keyboard.add(InlineKeyboardButton(text="📊 Diagrammalar", callback_data="show_charts"))
+        keyboard.add(InlineKeyboardButton(text="📥 Eksport (CSV)", callback_data="export_stats"))
+        keyboard.adjust(2)
+
+        await message.answer("\n".join(stats_message), reply_markup=keyboard.as_markup(), parse_mode=ParseMode.HTML)
+
+    except Exception as e:
+        logger.error(f"Error in show_statistics: {e}")
+        await message.answer("Xatolik yuz berdi. Iltimos, qaytadan urinib ko'ring.")
+
+
+async def show_info(message: types.Message, state: FSMContext, session: AsyncSession):
+    info_text = ("ℹ️ Doctor AI Bot haqida\n\n"
+                 "🤖 Bu bot sizga umumiy tibbiy maslahat berish uchun yaratilgan. "
+                 "Bot orqali dori-darmonlar, shifokorlar va kasalxonalar haqida "
+                 "ma'lumot olishingiz mumkin.\n\n"
+                 "⚠️ Eslatma: Bot orqali berilgan ma'lumotlar faqat maslahat uchun bo'lib, "
+                 "aniq tashxis va davolanish uchun shifokorga murojaat qilishingiz kerak.")
+    await message.answer(info_text, reply_markup=get_main_keyboard())
+
+
+MAIN_MENU_ACTIONS: Dict[str, MenuAction] = {"🩺 Savol berish": ask_question, "📊 Statistika": show_statistics,
+                                             "ℹ️ Ma'lumot": show_info}
+
+
+# Registered before the consultation state handlers so the menu buttons work in every state
+@dp.message(F.text.in_(frozenset(MAIN_MENU_ACTIONS)))
+async def handle_main_menu(message: types.Message, state: FSMContext, session: AsyncSession):
+    # Tapping a menu button ends whatever consultation flow was in progress
+    await state.clear()
+    await MAIN_MENU_ACTIONS[message.text](message, state, session)
+
+
 @dp.message(ConsultationStates.category_selection)
 async def handle_category_selection(message: types.Message, state: FSMContext):
     categories = {"👨‍⚕️ Umumiy maslahat": "general", "💊 Dori-darmonlar": "medicine", "🏥 Kasalxonalar": "hospitals",
@@ -328,20 +564,15 @@ async def handle_category_selection(message: types.Message, state: FSMContext):
     await state.update_data(category=selected_category, category_name=message.text, conversation_history=[])
     await state.set_state(ConsultationStates.conversation)
 
-    keyboard = ReplyKeyboardBuilder()
-    keyboard.add(KeyboardButton(text="🔙 Asosiy menyu"))
-    keyboard.add(KeyboardButton(text="🔄 Kategoriyani o'zgartirish"))
-    keyboard.adjust(1)
-
     await message.answer(f"✅ <b>{message.text}</b> bo'yicha savol-javob sessiyasi boshlandi.\n\n"
                          "✍️ Savolingizni yozing:\n\n"
                          "📝 Eslatma: Siz asosiy menyuga qaytmaguncha yoki kategoriyani "
                          "o'zgartirmaguncha shu mavzu bo'yicha savollar berishingiz mumkin.",
-                         reply_markup=keyboard.as_markup(resize_keyboard=True), parse_mode=ParseMode.HTML)
+                         reply_markup=get_conversation_keyboard(), parse_mode=ParseMode.HTML)
 
 
 @dp.message(ConsultationStates.conversation)
-async def handle_conversation(message: types.Message, state: FSMContext):
+async def handle_conversation(message: types.Message, state: FSMContext, session: AsyncSession):
     try:
         if message.text == "🔙 Asosiy menyu":
             await state.clear()
@@ -365,29 +596,54 @@ async def handle_conversation(message: types.Message, state: FSMContext):
 
         await message.chat.do(ChatAction.TYPING)
 
-        context = f"Kategoriya: {category_name}\n\nOldingi savol-javoblar:\n"
-        for qa in conversation_history[-3:]:
-            context += f"Savol: {qa['question']}\nJavob: {qa['answer']}\n\n"
-        context += f"Yangi savol: {message.text}"
-
-        response = await ai_generator.generate_response(category, context)
-
-        conversation_history.append({'question': message.text, 'answer': response})
+        previous_qa = "".join(f"Savol: {qa['question']}\nJavob: {qa['answer']}\n\n"
+                              for qa in conversation_history[-CONVERSATION_HISTORY_LIMIT:])
+        context = f"Kategoriya: {category_name}\n\nOldingi savol-javoblar:\n{previous_qa}Yangi savol: {message.text}"
+
+        # Show the answer while it is generated; intermediate edits are throttled and best-effort
+        answer_message = await message.answer("✍️ Javob tayyorlanmoqda...", reply_markup=get_conversation_keyboard())
+        loop = asyncio.get_running_loop()
+        response = ""
+        sent_text = ""
+        last_edit_at = loop.time()
+        async for response in get_ai().stream_response(category, context):
+            if (len(response) - len(sent_text) > STREAM_EDIT_CHARS and len(response) <= TELEGRAM_MESSAGE_LIMIT
+                    and loop.time() - last_edit_at >= STREAM_EDIT_INTERVAL):
+                try:
+                    await answer_message.edit_text(response)
+                    sent_text = response
+                except TelegramAPIError as e:
+                    logger.warning(f"Skipped streamed answer edit: {e}")
+                last_edit_at = loop.time()
+
+        # Save before the final sends so a Telegram error cannot skip the record or the daily counter. Only the
+        # turns used as context are kept, without the repeated disclaimer, so the state blob stays small.
+        conversation_history = (conversation_history + [{'question': message.text,
+                                                         'answer': response.removesuffix(DISCLAIMER)}]
+                                )[-CONVERSATION_HISTORY_LIMIT:]
         await state.update_data(conversation_history=conversation_history)
 
-        consultation = await DatabaseManager.save_consultation(message.from_user.id, category, message.text, response)
-        await DatabaseManager.update_consultation_count(message.from_user.id)
-
-        keyboard = ReplyKeyboardBuilder()
-        keyboard.add(KeyboardButton(text="🔙 Asosiy menyu"))
-        keyboard.add(KeyboardButton(text="🔄 Kategoriyani o'zgartirish"))
-        keyboard.adjust(1)
-
-        await message.answer(response, reply_markup=keyboard.as_markup(resize_keyboard=True))
+        consultation = await DatabaseManager.save_consultation(message.from_user.id, category, message.text, response,
+                                                               session=session)
+
+        # The final edit keeps to the same interval, and waits once more if Telegram still asks for it
+        final_text = response[:TELEGRAM_MESSAGE_LIMIT]
+        if final_text != sent_text:
+            await asyncio.sleep(max(0.0, STREAM_EDIT_INTERVAL - (loop.time() - last_edit_at)))
+            try:
+                await answer_message.edit_text(final_text)
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                await answer_message.edit_text(final_text)
+        # Answers longer than one message continue in follow-up messages
+        for start in range(TELEGRAM_MESSAGE_LIMIT, len(response), TELEGRAM_MESSAGE_LIMIT):
+            await message.answer(response[start:start + TELEGRAM_MESSAGE_LIMIT])
 
         feedback_keyboard = InlineKeyboardBuilder()
         for i in range(1, 6):
-            feedback_keyboard.add(InlineKeyboardButton(text=f"{'⭐' * i}", callback_data=f"rate_{consultation.id}_{i}"))
+            feedback_keyboard.add(InlineKeyboardButton(text=f"{'⭐' * i}",
+                                                       callback_data=RateCallback(consultation_id=consultation.id,
+                                                                                  score=i).pack()))
         feedback_keyboard.adjust(5)
 
         await message.answer("Javobdan qanchalik qoniqding? (1-5 yulduz):", reply_markup=feedback_keyboard.as_markup())
@@ -398,82 +654,23 @@ async def handle_conversation(message: types.Message, state: FSMContext):
         await state.clear()
 
 
-@dp.callback_query(lambda c: c.data.startswith('rate_'))
-async def process_feedback(callback_query: types.CallbackQuery):
+@dp.callback_query(RateCallback.filter())
+async def process_feedback(callback_query: types.CallbackQuery, callback_data: RateCallback, session: AsyncSession):
     try:
-        _, consultation_id, score = callback_query.data.split('_')
-        await DatabaseManager.update_feedback(int(consultation_id), int(score))
-        await callback_query.message.edit_text(f"✅ Rahmat! Sizning bahoyingiz: {'⭐' * int(score)}")
+        await DatabaseManager.update_feedback(callback_data.consultation_id, callback_data.score, session=session)
+        await callback_query.message.edit_text(f"✅ Rahmat! Sizning bahoyingiz: {'⭐' * callback_data.score}")
     except Exception as e:
         logger.error(f"Error in process_feedback: {e}")
         await callback_query.message.edit_text("Xatolik yuz berdi. Iltimos, qaytadan urinib ko'ring.")
 
 
-@dp.message(F.text == "📊 Statistika")
-async def show_statistics(message: types.Message):
-    try:
-        user = await DatabaseManager.get_user(message.from_user.id)
-        if not user:
-            await message.answer("Foydalanuvchi ma'lumotlari topilmadi.")
-            return
-
-        category_stats = await StatisticsManager.get_category_stats(user.user_id)
-        weekly_activity = await StatisticsManager.get_weekly_activity(user.user_id)
-        feedback_dist = await StatisticsManager.get_feedback_distribution(user.user_id)
-        recent_consultations = await StatisticsManager.get_recent_consultations(user.user_id)
-
-        stats_message = ["📊 <b>Statistika</b>\n", f"👤 Foydalanuvchi: {user.first_name}",
-                         f"📅 Ro'yxatdan o'tgan sana: {user.created_at.strftime('%Y-%m-%d')}",
-                         f"💬 Jami maslahatlar: {user.consultation_count}",
-                         f"📈 Bugungi maslahatlar: {user.daily_consultation_count}",
-                         f"⭐ O'rtacha baho: {user.feedback_score:.1f}/5.0\n"]
-
-        if category_stats:
-            stats_message.append("📊 <b>Kategoriyalar bo'yicha statistika:</b>")
-            for category, count in category_stats:
-                stats_message.append(f"- {category}: {count} ta")
-            stats_message.append("")
-
-        stats_message.append("📅 <b>Haftalik faollik:</b>")
-        for date, count in weekly_activity.items():
-            weekday = datetime.strptime(date, '%Y-%m-%d').strftime('%A')
-            stats_message.append(f"- {weekday}: {count} ta maslahat")
-        stats_message.append("")
-
-        if feedback_dist:
-            stats_message.append("⭐ <b>Baholar taqsimoti:</b>")
-            total_feedback = sum(feedback_dist.values())
-            for score, count in feedback_dist.items():
-                percentage = (count / total_feedback) * 100
-                stars = "⭐" * score
-                stats_message.append(f"{stars}: {count} ta ({percentage:.1f}%)")
-            stats_message.append("")
-
-        if recent_consultations:
-            stats_message.append("🕐 <b>Oxirgi maslahatlar:</b>")
-            for cons in recent_consultations:
-                date = cons.created_at.strftime("%Y-%m-%d %H:%M")
-                stats_message.append(f"- {date}: {cons.category}")
-
-        keyboard = InlineKeyboardBuilder()
-        keyboard.add(InlineKeyboardButton(text="📊 Diagrammalar", callback_data="show_charts"))
-        keyboard.add(InlineKeyboardButton(text="📥 Eksport (CSV)", callback_data="export_stats"))
-        keyboard.adjust(2)
-
-        await message.answer("\n".join(stats_message), reply_markup=keyboard.as_markup(), parse_mode=ParseMode.HTML)
-
-    except Exception as e:
-        logger.error(f"Error in show_statistics: {e}")
-        await message.answer("Xatolik yuz berdi. Iltimos, qaytadan urinib ko'ring.")
-
-
 @dp.callback_query(lambda c: c.data == "show_charts")
 async def show_charts(callback_query: types.CallbackQuery):
     try:
         user_id = callback_query.from_user.id
-        category_stats = await StatisticsManager.get_category_stats(user_id)
-        weekly_activity = await StatisticsManager.get_weekly_activity(user_id)
-        feedback_dist = await StatisticsManager.get_feedback_distribution(user_id)
+        category_stats, weekly_activity, feedback_dist = await asyncio.gather(
+            StatisticsManager.get_category_stats(user_id), StatisticsManager.get_weekly_activity(user_id),
+            StatisticsManager.get_feedback_distribution(user_id))
 
         # Generate charts using HTML and JavaScript
         html_content = f"""
@@ -491,7 +688,7 @@ async def show_charts(callback_query: types.CallbackQuery):
                 Plotly.newPlot('category_chart', categoryData, categoryLayout);
 
                 var weeklyData = [{{
-                    x: {list(weekly_activity.keys())},
+                    x: {[str(day) for day in weekly_activity]},
                     y: {list(weekly_activity.values())},
                     type: 'bar'
                 }}];
@@ -510,12 +707,9 @@ async def show_charts(callback_query: types.CallbackQuery):
         </html>
         """
 
-        with open("charts.html", "w", encoding="utf-8") as f:
-            f.write(html_content)
-
-        await callback_query.message.answer_document(types.FSInputFile("charts.html"),
-                                                     caption="📊 Statistika diagrammalari")
-        os.remove("charts.html")
+        await callback_query.message.answer_document(
+            types.BufferedInputFile(html_content.encode('utf-8'), filename="charts.html"),
+            caption="📊 Statistika diagrammalari")
 
     except Exception as e:
         logger.error(f"Error in show_charts: {e}")
@@ -523,17 +717,19 @@ async def show_charts(callback_query: types.CallbackQuery):
 
 
 @dp.callback_query(lambda c: c.data == "export_stats")
-async def export_statistics(callback_query: types.CallbackQuery):
+async def export_statistics(callback_query: types.CallbackQuery, session: AsyncSession):
     try:
         user_id = callback_query.from_user.id
-        consultations = await StatisticsManager.get_recent_consultations(user_id, limit=1000)
+        consultations = await StatisticsManager.get_recent_consultations(user_id, limit=1000, session=session)
 
-        csv_content = "Sana,Kategoriya,Savol,Javob,Baho\n"
-        for cons in consultations:
-            csv_content += f"{cons.created_at},{cons.category},\"{cons.content}\",\"{cons.response}\",{cons.feedback_score or ''}\n"
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["Sana", "Kategoriya", "Savol", "Javob", "Baho"])
+        writer.writerows((cons.created_at, cons.category, cons.content, cons.response, cons.feedback_score or '')
+                         for cons in consultations)
 
         await callback_query.message.answer_document(
-            types.BufferedInputFile(csv_content.encode(), filename="statistika.csv"),
+            types.BufferedInputFile(buffer.getvalue().encode('utf-8'), filename="statistika.csv"),
             caption="📊 Statistika ma'lumotlari CSV formatida")
 
     except Exception as e:
@@ -541,24 +737,38 @@ async def export_statistics(callback_query: types.CallbackQuery):
         await callback_query.message.answer("Statistikani eksport qilishda xatolik yuz berdi.")
 
 
-@dp.message(F.text == "ℹ️ Ma'lumot")
-async def show_info(message: types.Message):
-    info_text = ("ℹ️ Doctor AI Bot haqida\n\n"
-                 "🤖 Bu bot sizga umumiy tibbiy maslahat berish uchun yaratilgan. "
-                 "Bot orqali dori-darmonlar, shifokorlar va kasalxonalar haqida "
-                 "ma'lumot olishingiz mumkin.\n\n"
-                 "⚠️ Eslatma: Bot orqali berilgan ma'lumotlar faqat maslahat uchun bo'lib, "
-                 "aniq tashxis va davolanish uchun shifokorga murojaat qilishingiz kerak.")
-    await message.answer(info_text, reply_markup=get_main_keyboard())
+# Main execution
+async def run_webhook():
+    # Without a secret anyone who finds the webhook URL could post forged updates
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET must be set to run in webhook mode")
+    await bot.set_webhook(f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET)
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    logging.info(f"Webhook server listening on {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 
-# Main execution
 async def main():
     logging.info("Starting the bot...")
     try:
         await DatabaseManager.init_db()
+        await DatabaseManager.warm_up_pool()
         logging.info("Database initialized successfully")
-        await dp.start_polling(bot)
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            # Telegram rejects getUpdates while a webhook is registered, e.g. from an earlier webhook run
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     except Exception as e:
         logging.error(f"Error during bot startup: {e}")
     finally:
@@ -566,4 +776,10 @@ async def main():
 
 
 if __name__ == "__main__":
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        # uvloop is unavailable on Windows; the default asyncio loop works everywhere
+        pass
     asyncio.run(main())